@@ -32,14 +32,23 @@ if "QONDOR_BATCHMODE" in os.environ:
     BATCHMODE = True
 
 # Global variable to check if the htcondor bindings are installed
+# Only looks the module up; the (slow) import itself happens when the bindings are used
 try:
-    import htcondor
+    from importlib.util import find_spec  # python 3
 
-    logger.debug("The python bindings for htcondor are imported")
-    BINDINGS_INSTALLED = True
+    BINDINGS_INSTALLED = find_spec("htcondor") is not None
 except ImportError:
+    import imp  # python 2
+
+    try:
+        imp.find_module("htcondor")
+        BINDINGS_INSTALLED = True
+    except ImportError:
+        BINDINGS_INSTALLED = False
+if BINDINGS_INSTALLED:
+    logger.debug("The python bindings for htcondor are installed")
+else:
     logger.debug("The python bindings for htcondor do not seem to be installed")
-    BINDINGS_INSTALLED = False
 
 COLLECTOR_NODES = None
 DEFAULT_MGM = None
@@ -117,11 +126,12 @@ class Scope(argparse.Namespace):
                     d = _json_load_byteified(f)
                     scope.__dict__.update(d)
                 self.is_loaded = True
-                logger.info(
-                    "Loaded following scope from %s:\n%s",
-                    scope_file,
-                    pprint.pformat(scope),
-                )
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        "Loaded following scope from %s:\n%s",
+                        scope_file,
+                        pprint.pformat(scope),
+                    )
                 return
         logger.info("Could not load scope")
 
@@ -1,24 +1,84 @@
+import fnmatch
 import logging
 import os
+import re
+
+try:
+    from configparser import RawConfigParser  # python 3
+except ImportError:
+    from ConfigParser import RawConfigParser  # python 2
 
 logger = logging.getLogger("qondor")
 
 
-def cmsconnect_get_all_sites():
+CICONNECT_CONFIG = "/etc/ciconnect/config.ini"
+
+# Parsed DefaultSites per (path, modification time) of the ciconnect config
+_CICONNECT_CACHE = {}
+
+
+def cmsconnect_get_all_sites(config=CICONNECT_CONFIG):
     """
-    Reads the central config for cmsconnect to determine the list of all available sites
+    Reads the central config for cmsconnect to determine the list of all available sites.
+    The config is only parsed again if it was modified since the last call.
     """
     try:
-        from configparser import RawConfigParser  # python 3
-    except ImportError:
-        import ConfigParser  # python 2
+        key = (config, os.stat(config).st_mtime)
+    except OSError:
+        key = None
+    if key is None or key not in _CICONNECT_CACHE:
+        cfg = RawConfigParser()
+        cfg.read(config)
+        # Normalize once: strip whitespace, drop empty entries and duplicates
+        sites = frozenset(
+            site.strip()
+            for site in cfg.get("submit", "DefaultSites").split(",")
+            if site.strip()
+        )
+        if key is None:
+            return set(sites)
+        _CICONNECT_CACHE[key] = sites
+    return set(_CICONNECT_CACHE[key])
+
+
+_SITE_PATTERNS_CACHE = {}
+
+
+def compile_site_patterns(patterns):
+    """
+    Compiles a list of fnmatch-style site patterns into a single regex
+    that matches a site if any of the patterns matches it.
+    Compiled regexes are cached per set of patterns.
+    """
+    key = tuple(sorted(set(patterns)))
+    if key not in _SITE_PATTERNS_CACHE:
+        _SITE_PATTERNS_CACHE[key] = re.compile(
+            "|".join(fnmatch.translate(pattern) for pattern in key)
+        )
+    return _SITE_PATTERNS_CACHE[key]
+
+
+_GLOB_META_RE = re.compile(r"[*?\[]")
+
 
-        RawConfigParser = ConfigParser.RawConfigParser
-    cfg = RawConfigParser()
-    cfg.read("/etc/ciconnect/config.ini")
-    sites = cfg.get("submit", "DefaultSites").split(",")
-    all_sites = set(sites)
-    return all_sites
+def match_sites(sites, patterns):
+    """
+    Returns the set of sites that match any of the fnmatch-style patterns.
+    Patterns without glob characters are plain site names, which are matched
+    by set lookup without compiling a regex.
+    """
+    literals = set()
+    globs = []
+    for pattern in patterns:
+        if _GLOB_META_RE.search(pattern):
+            globs.append(pattern)
+        else:
+            literals.add(pattern)
+    matched = sites & literals
+    if globs:
+        globs_re = compile_site_patterns(globs)
+        matched.update(site for site in sites if globs_re.match(site))
+    return matched
 
 
 def cmsconnect_settings(sub, blacklist=None, whitelist=None, cli=False):
@@ -29,54 +89,47 @@ def cmsconnect_settings(sub, blacklist=None, whitelist=None, cli=False):
     Modifies the dict in place.
     """
     all_sites = cmsconnect_get_all_sites()
+    # Only build the joined site lists for the log if they will be printed
+    log_sites = logger.isEnabledFor(logging.INFO)
 
     # Check whether the user whitelisted or blacklisted some sites
     desired_sites = None
     if blacklist or whitelist:
-        import fnmatch
-
-        blacklisted = []
-        whitelisted = []
-        # Build the blacklist
+        desired_sites = all_sites
+        # Apply the blacklist
         if blacklist:
-            for blacksite_pattern in blacklist:
-                for site in all_sites:
-                    if fnmatch.fnmatch(site, blacksite_pattern):
-                        blacklisted.append(site)
-        # Build the whitelist
+            blacklisted = match_sites(all_sites, blacklist)
+            if log_sites:
+                logger.info("Blacklisting: %s", ",".join(sorted(blacklisted)))
+            desired_sites = desired_sites - blacklisted
+        # Apply the whitelist
         if whitelist:
-            for whitesite_pattern in whitelist:
-                for site in all_sites:
-                    if fnmatch.fnmatch(site, whitesite_pattern):
-                        whitelisted.append(site)
-        # Convert to list and sort
-        blacklisted = list(set(blacklisted))
-        blacklisted.sort()
-        whitelisted = list(set(whitelisted))
-        whitelisted.sort()
-        logger.info("Blacklisting: %s", ",".join(blacklisted))
-        logger.info("Whitelisting: %s", ",".join(whitelisted))
-        desired_sites = list(
-            (set(all_sites) - set(blacklisted)).union(set(whitelisted))
-        )
-        desired_sites.sort()
+            whitelisted = match_sites(all_sites, whitelist)
+            if log_sites:
+                logger.info("Whitelisting: %s", ",".join(sorted(whitelisted)))
+            desired_sites = desired_sites | whitelisted
+        desired_sites = sorted(desired_sites)
 
     # Add a plus only if submitting via .jdl file
-    def addplus(key):
-        return "+" + key if cli else key
+    prefix = "+" if cli else ""
 
     if desired_sites:
-        logger.info("Submitting to desired sites: %s", ",".join(desired_sites))
-        sub[addplus("DESIRED_Sites")] = '"' + ",".join(desired_sites) + '"'
-    else:
+        desired_sites = ",".join(desired_sites)
+        logger.info("Submitting to desired sites: %s", desired_sites)
+        sub[prefix + "DESIRED_Sites"] = '"' + desired_sites + '"'
+    elif log_sites:
         logger.info("Submitting to all sites: %s", ",".join(all_sites))
     if not cli:
-        sub[addplus("ConnectWrapper")] = '"2.0"'
-        sub[addplus("CMSGroups")] = '"/cms,T3_US_FNALLPC"'
-        sub[addplus("MaxWallTimeMins")] = "500"
-        sub[addplus("ProjectName")] = '"cms.org.fnal"'
-        sub[addplus("SubmitFile")] = '"irrelevant.jdl"'
-        sub[addplus("AccountingGroup")] = '"analysis.{0}"'.format(os.environ["USER"])
+        sub.update(
+            {
+                "ConnectWrapper": '"2.0"',
+                "CMSGroups": '"/cms,T3_US_FNALLPC"',
+                "MaxWallTimeMins": "500",
+                "ProjectName": '"cms.org.fnal"',
+                "SubmitFile": '"irrelevant.jdl"',
+                "AccountingGroup": '"analysis.{0}"'.format(os.environ["USER"]),
+            }
+        )
         logger.warning(
             "FIXME: CMS Connect settings currently hard-coded for a FNAL user"
         )
@@ -1529,7 +1529,21 @@ RELEASES = {
 }
 
 
+# Arches found by get_arch, per passed cmssw version string
+_ARCH_CACHE = {}
+
+
 def get_arch(cmssw_version):
+    """
+    Returns the most likely SCRAM_ARCH for a CMSSW version, based on RELEASES.
+    Results are cached; invalid versions raise a RuntimeError every time.
+    """
+    if cmssw_version not in _ARCH_CACHE:
+        _ARCH_CACHE[cmssw_version] = _get_arch(cmssw_version)
+    return _ARCH_CACHE[cmssw_version]
+
+
+def _get_arch(cmssw_version):
     # Passed string must contain a X_Y_Z-like version substring
     match = re.search(r"CMSSW_\d+_\d+_\d+", cmssw_version)
     if not match:
@@ -263,5 +263,5 @@ class Resubmission(object):
                 for job in jobs:
                     logger.info("Submitting job %s", job)
                     sub["environment"]["QONDOR_PROC_ID_RESUBMISSION"] = job.proc_id
-                    session.submittables.append((sub, 1))
+                    session.add_submittable(sub, 1)
             session.submit(cli)
@@ -1,11 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import logging
-import os
 import pprint
 import re
 from contextlib import contextmanager
-from time import sleep, strftime
+from time import sleep
 
 import qondor
 
@@ -128,9 +127,11 @@ class ScheddManager(object):
             # This is most likely to work for most batch systems
             collector = htcondor.Collector()
             limited_schedd_ad = collector.locate(htcondor.DaemonTypes.Schedd)
-            logger.debug(
-                "Retrieved limited schedd ad:\n%s", pprint.pformat(limited_schedd_ad)
-            )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Retrieved limited schedd ad:\n%s",
+                    pprint.pformat(limited_schedd_ad),
+                )
             self.schedd_ads = collector.query(
                 htcondor.AdTypes.Schedd,
                 projection=schedd_ad_projection,
@@ -165,9 +166,11 @@ class ScheddManager(object):
                 )
                 raise RuntimeError
 
-        logger.debug(
-            "Found schedd ads: \n%s", pprint.pformat([dict(d) for d in self.schedd_ads])
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Found schedd ads: \n%s",
+                pprint.pformat([dict(d) for d in self.schedd_ads]),
+            )
         return self.schedd_ads
 
     @cache_return_value
@@ -429,45 +432,10 @@ def get_jobs(*args, **kwargs):
 def get_default_sub():
     """
     Returns the default submission dict (the equivalent of a .jdl file)
-    to be used by the submitter.
+    to be used by the submitter. Thin wrapper around
+    qondor.submit.get_default_sub, so the proxy lookup is shared.
     """
-    sub = {
-        "universe": "vanilla",
-        "output": "out_$(Cluster)_$(Process).txt",
-        "error": "err_$(Cluster)_$(Process).txt",
-        "log": "log_$(Cluster)_$(Process).txt",
-        "should_transfer_files": "YES",
-        "environment": {
-            "QONDOR_BATCHMODE": "1",
-            "CONDOR_CLUSTER_NUMBER": "$(Cluster)",
-            "CONDOR_PROCESS_ID": "$(Process)",
-            "CLUSTER_SUBMISSION_TIMESTAMP": strftime(qondor.TIMESTAMP_FMT),
-        },
-    }
-    # Try to set some more things
-    try:
-        sub["x509userproxy"] = os.environ["X509_USER_PROXY"]
-    except KeyError:
-        try:
-            sub["x509userproxy"] = qondor.utils.run_command(
-                ["voms-proxy-info", "-path"]
-            )[0].strip()
-            logger.info(
-                'Set x509userproxy to "%s" based on output from voms-proxy-info',
-                sub["x509userproxy"],
-            )
-        except Exception:
-            logger.warning(
-                "Could not find a x509userproxy to pass; manually "
-                "set the htcondor variable 'x509userproxy' if your "
-                "htcondor setup requires it."
-            )
-    try:
-        sub["environment"]["USER"] = os.environ["USER"]
-    except KeyError:
-        # No user specified, no big deal
-        pass
-    return sub
+    return qondor.submit.get_default_sub()
 
 
 def _change_submitobject_env_variable(submitobject, key, value):
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import itertools
 import json
 import logging
 import os
@@ -8,6 +9,16 @@ import re
 import shutil
 from datetime import datetime
 
+try:  # py3
+    from shlex import quote
+except ImportError:  # py2
+    from pipes import quote
+
+try:  # py3
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # py2 without the futures backport; write job files serially
+    ThreadPoolExecutor = None
+
 import seutils
 
 import qondor
@@ -19,42 +30,48 @@ logger = logging.getLogger("qondor")
 # Interface to translate python code (typically in a file) into job submissions
 
 
-def split_runcode_submitcode(lines):
+_SUBMIT_DELIMITER_RE = re.compile(r'^"""# (submit|endsubmit).*\n?', re.M)
+_CONDOR_SUBMIT_OUTPUT_RE = re.compile(r"(\d+) job\(s\) submitted to cluster (\d+)")
+
+
+def split_runcode_submitcode(source):
     """
-    Splits a list of lines into two strings, the python to run in the job
+    Splits python source code into two strings, the python to run in the job
     and the other the python code to submit the jobs.
+    A list of lines (as returned by readlines()) is also accepted.
     """
-    runcode_lines = []
-    submitcode_lines = []
-    is_runcode_mode = True
+    if not qondor.utils.is_string(source):
+        source = "".join(source)
+    if '"""# ' not in source:
+        # No submit blocks at all; skip the regex scan
+        return source, ""
+    runcode_pieces = []
+    submitcode_pieces = []
     is_submitcode_mode = False
-    for line in lines:
-        line = line.strip("\n")
-        if line.startswith('"""# submit'):
+    begin = 0
+    for match in _SUBMIT_DELIMITER_RE.finditer(source):
+        if match.group(1) == "submit":
             if is_submitcode_mode:
                 raise Exception(
                     "Encountered submit code opening tag, but was already in submit mode"
                 )
-            # Toggle the mode
-            is_runcode_mode = not (is_runcode_mode)
-            is_submitcode_mode = not (is_submitcode_mode)
-            continue
-        elif line.startswith('"""# endsubmit'):
-            if is_runcode_mode:
+            runcode_pieces.append(source[begin : match.start()])
+        else:
+            if not is_submitcode_mode:
                 raise Exception(
                     "Encountered submit code closing tag, but was already not in submit mode"
                 )
-            # Toggle the mode
-            is_runcode_mode = not (is_runcode_mode)
-            is_submitcode_mode = not (is_submitcode_mode)
-            continue
-        else:
-            if is_runcode_mode:
-                runcode_lines.append(line)
-            else:
-                submitcode_lines.append(line)
-    submitcode = "\n".join(submitcode_lines)
-    runcode = "\n".join(runcode_lines)
+            submitcode_pieces.append(source[begin : match.start()])
+        # Toggle the mode
+        is_submitcode_mode = not (is_submitcode_mode)
+        begin = match.end()
+    # Remainder after the last tag
+    if is_submitcode_mode:
+        submitcode_pieces.append(source[begin:])
+    else:
+        runcode_pieces.append(source[begin:])
+    submitcode = "".join(submitcode_pieces)
+    runcode = "".join(runcode_pieces)
     return runcode, submitcode
 
 
@@ -63,7 +80,7 @@ def split_runcode_submitcode_file(filename):
     Wrapper for split_runcode_submitcode that opens up the file first
     """
     with open(filename, "r") as f:
-        return split_runcode_submitcode(f.readlines())
+        return split_runcode_submitcode(f.read())
 
 
 def exec_wrapper(code, scope):
@@ -74,6 +91,24 @@ def exec_wrapper(code, scope):
     exec(code, scope)
 
 
+# Only the last few submit codes are kept; the key holds the full source
+_COMPILED_SUBMITCODE = qondor.utils.LRUCache(32)
+
+
+def compile_submitcode(submitcode, filename):
+    """
+    Compiles the submit code of a python job file, caching the code object
+    so that repeated submissions of the same source are not parsed again
+    """
+    key = (submitcode, filename)
+    if key not in _COMPILED_SUBMITCODE:
+        # Line numbers are relative to the submit code, not to the file
+        _COMPILED_SUBMITCODE[key] = compile(
+            submitcode, "<submit code of {}>".format(filename), "exec"
+        )
+    return _COMPILED_SUBMITCODE[key]
+
+
 class StopProcessing(Exception):
     """
     Special exception to stop execution inside an exec statement
@@ -134,6 +169,7 @@ def submit_python_job_file(
         "njobsmax": njobsmax,
         "return_first_cluster": return_first_cluster,
     }
+    submitcode = compile_submitcode(submitcode, filename)
     logger.info("Running submission code now")
     if return_first_cluster:
         try:
@@ -196,6 +232,64 @@ RUN_ENVS = {
 }
 
 
+# Static first part of the .sh entrypoint: Divert almost all output to the stderr,
+# and setup cms scripts
+_SH_HEADER = [
+    "#!/bin/bash",
+    "set -e",
+    'echo "hostname: $(hostname)"',
+    'echo "date:     $(date)"',
+    'echo "pwd:      $(pwd)"',
+    'echo "ls -al:"',
+    "ls -al",
+    'echo "Redirecting all output to stderr from here on out"',
+    "exec 1>&2",
+    "",
+    "export VO_CMS_SW_DIR=/cvmfs/cms.cern.ch/",
+    "source /cvmfs/cms.cern.ch/cmsset_default.sh",
+    "env > bare_env.txt",  # Save the environment before doing any other environment setup
+    "",
+]
+
+# Set up a directory to install python packages in, and put on the path
+# Currently requires $pipdir to be defined... might want to figure out something more clever
+_SH_PIP_SETUP = [
+    'echo "Setting up custom pip install dir"',
+    'HOME="$(pwd)"',
+    'export pip_install_dir="$(pwd)/install"',
+    'export PATH="${pip_install_dir}/bin:${PATH}"',
+    "export PYTHONVERSION=$(python -c \"import sys; print('{}.{}'.format(sys.version_info.major, sys.version_info.minor))\")",
+    'export PYTHONPATH="${pip_install_dir}/lib/python${PYTHONVERSION}/site-packages:${PYTHONPATH}"',
+    'mkdir -p "${pip_install_dir}/bin"',
+    'mkdir -p "${pip_install_dir}/lib/python${PYTHONVERSION}/site-packages"',
+    "",
+    "pip -V",
+    "which pip",
+    "",
+]
+
+# Last part of the .sh entrypoint, after the python call:
+# Store the python exit code in a file, to easily check whether jobs succeeded
+_SH_FOOTER = 'echo "$?" > exitcode_${QONDORCLUSTERNAME}_${CONDOR_CLUSTER_NUMBER}_${CONDOR_PROCESS_ID}.txt\n'
+
+_SH_PREAMBLE_CACHE = {}
+
+
+def get_sh_preamble(run_env, is_conda_pack=False):
+    """
+    Returns the part of the .sh entrypoint that does not depend on the cluster,
+    up to the pip installs. Cached per runtime environment.
+    """
+    key = (tuple(run_env), is_conda_pack)
+    if key not in _SH_PREAMBLE_CACHE:
+        # Set the runtime environment (typically sourcing scripts to get the right python/gcc/ROOT/etc.)
+        sh = _SH_HEADER + list(run_env) + ["", "set -uxoE pipefail"]
+        if not is_conda_pack:
+            sh += _SH_PIP_SETUP
+        _SH_PREAMBLE_CACHE[key] = "\n".join(sh)
+    return _SH_PREAMBLE_CACHE[key]
+
+
 def get_default_sub(submission_time=None):
     """
     Returns the default submission dict (the equivalent of a .jdl file)
@@ -222,15 +316,14 @@ def get_default_sub(submission_time=None):
     try:
         sub["x509userproxy"] = os.environ["X509_USER_PROXY"]
     except KeyError:
-        try:
-            sub["x509userproxy"] = qondor.utils.run_command(
-                ["voms-proxy-info", "-path"]
-            )[0].strip()
+        x509userproxy = qondor.utils.get_voms_proxy_path()
+        if x509userproxy:
+            sub["x509userproxy"] = x509userproxy
             logger.info(
                 'Set x509userproxy to "%s" based on output from voms-proxy-info',
                 sub["x509userproxy"],
             )
-        except Exception:
+        else:
             logger.warning(
                 "Could not find a x509userproxy to pass; manually "
                 "set the htcondor variable 'x509userproxy' if your "
@@ -264,6 +357,57 @@ def update_sub(sub, other):
     return r
 
 
+def get_common_jdl_settings(subs):
+    """
+    Returns the settings that have the same value in all submission dicts,
+    which only need to be written once at the top of a .jdl file.
+    The environment is always kept per cluster.
+    """
+    first = subs[0]
+    return dict(
+        (key, val)
+        for key, val in first.items()
+        if key.lower() != "environment"
+        and all(key in sub and sub[key] == val for sub in subs[1:])
+    )
+
+
+def format_jdl_block(sub, njobs, environment=None, common=None):
+    """
+    Formats a submission dict as a block of text for a .jdl file,
+    ending with the queue statement.
+    If environment is given, it is used as the already formatted
+    environment string.
+    Keys in common are assumed to be set already earlier in the .jdl file,
+    and are skipped.
+    """
+    lines = ["# Cluster {}".format(sub["environment"]["QONDORICLUSTER"])]
+    for key, val in sub.items():
+        if common and key in common:
+            continue
+        if key.lower() == "environment":
+            val = (
+                qondor.schedd.format_env_htcondor(val)
+                if environment is None
+                else environment
+            )
+        lines.append("{} = {}".format(key, val))
+    lines.append("queue {}\n".format(njobs))
+    return "\n".join(lines)
+
+
+def write_file(path, contents, mode="w"):
+    """
+    Writes contents to path
+    """
+    with open(path, mode) as f:
+        f.write(contents)
+
+
+# Whether this is a CMS Connect login node, based on the hostname
+_IS_CMSCONNECT = os.uname()[1] in ("login.uscms.org", "login-el7.uscms.org")
+
+
 class Session(object):
     """
     Over-arching object that controls submission of a number of clusters
@@ -276,12 +420,23 @@ class Session(object):
             "{}_{}".format(name, self.submission_time.strftime(qondor.TIMESTAMP_FMT))
         )
         self.transfer_files = []
-        self._created_python_module_tarballs = {}
+        # Tarballs created for editable python packages, and the tarball per package
+        self._created_python_module_tarballs = set()
+        self._python_package_tarballs = {}
         self._i_seutils_tarball = 0
         self.submittables = []
         self._njobs_submitted = 0
         self.htcondor_settings = get_default_sub(self.submission_time)
         self._fixed_cmsconnect_specific_settings = False
+        # Formatted version of the session-wide environment variables
+        self._static_env = None
+        self._static_env_formatted = None
+        # Filenames in the rundir, listed once
+        self._rundir_contents = None
+        self._rundir_contents_path = None
+        # Threads to write job files with, and the pending writes
+        self._io_pool = None
+        self._pending_writes = []
         # Storage for submitted jobs
         self.submitted = []
 
@@ -291,6 +446,33 @@ class Session(object):
         """
         self.htcondor_settings[key] = value
 
+    def format_environment(self, env):
+        """
+        Formats the environment of a submission dict for htcondor.
+        The session-wide variables (which come first in every merged environment)
+        are formatted only once; only the per-cluster variables are formatted
+        per call.
+        """
+        static_env = self.htcondor_settings.get("environment", {})
+        if static_env != self._static_env:
+            self._static_env = static_env.copy()
+            # Strip the closing quote so per-cluster variables can be appended
+            formatted = qondor.schedd.format_env_htcondor(static_env)
+            self._static_env_formatted = formatted[:-1]
+        if not static_env:
+            return qondor.schedd.format_env_htcondor(env)
+        if any(env.get(key) != value for key, value in static_env.items()):
+            # A session-wide variable was overwritten for this cluster
+            return qondor.schedd.format_env_htcondor(env)
+        extra_env = [
+            "{0}='{1}'".format(key, value)
+            for key, value in env.items()
+            if key not in static_env
+        ]
+        if not extra_env:
+            return self._static_env_formatted + '"'
+        return self._static_env_formatted + " " + " ".join(extra_env) + '"'
+
     def fix_cmsconnect_specific_settings_once(self, cli):
         """
         Potentially process cmsconnect specific settings
@@ -301,7 +483,7 @@ class Session(object):
         self._fixed_cmsconnect_specific_settings = True
         blacklist = self.htcondor_settings.pop("cmsconnect_blacklist", None)
         whitelist = self.htcondor_settings.pop("cmsconnect_whitelist", None)
-        if os.uname()[1] == "login.uscms.org" or os.uname()[1] == "login-el7.uscms.org":
+        if _IS_CMSCONNECT:
             qondor.logger.warning("Detected CMS Connect; loading specific settings")
             qondor.cmsconnect.cmsconnect_settings(
                 self.htcondor_settings,
@@ -327,8 +509,31 @@ class Session(object):
         logger.info("Using seutils-cache tarball %s", actual_tarball)
         return actual_tarball
 
+    def create_python_package_tarballs(self, packages):
+        """
+        Creates tarballs for python packages for which no tarball was created yet.
+        Multiple tarballs are created in parallel threads (the work is done by
+        tar/git subprocesses). Packages that end up in the same tarball (e.g.
+        packages in the same git repository) share it.
+        """
+        todo = []
+        for package in packages:
+            if package in self._python_package_tarballs or package in todo:
+                continue
+            tarball = qondor.utils.get_python_module_tarball_path(
+                package, outdir=self.rundir
+            )
+            if tarball in self._created_python_module_tarballs:
+                self._python_package_tarballs[package] = tarball
+            else:
+                todo.append(package)
+        tarballs = qondor.utils.tarball_python_modules(todo, outdir=self.rundir)
+        self._python_package_tarballs.update(zip(todo, tarballs))
+        self._created_python_module_tarballs.update(tarballs)
+
     def handle_python_package_tarballs(self, cluster):
         # Put in python package tarballs required for the code in the job
+        editable_packages = []
         for package, install_instruction in cluster.pips:
             # Packages with a specific version should always be installed from pypi
             for c in ["<", "=", ">"]:
@@ -338,16 +543,15 @@ class Session(object):
             if install_instruction == "auto" and qondor.utils.dist_is_editable(package):
                 install_instruction = "editable"
             # If package was installed editably, tarball it up and include it
-            if install_instruction == "editable":
-                # Create the tarball if it wasn't already created
-                if package not in self._created_python_module_tarballs:
-                    self._created_python_module_tarballs[
-                        package
-                    ] = qondor.utils.tarball_python_module(package, outdir=self.rundir)
-                # Add the tarball as input file for this cluster
-                cluster.transfer_files[
-                    "_packagetarball_{}".format(package)
-                ] = self._created_python_module_tarballs[package]
+            if install_instruction == "editable" and package not in editable_packages:
+                editable_packages.append(package)
+        # Create the tarballs that weren't already created
+        self.create_python_package_tarballs(editable_packages)
+        # Add the tarballs as input files for this cluster
+        for package in editable_packages:
+            cluster.transfer_files[
+                "_packagetarball_{}".format(package)
+            ] = self._python_package_tarballs[package]
 
     def add_submission(self, cluster, cli=True, njobs=1, njobsmax=None):
         if njobsmax:
@@ -366,16 +570,23 @@ class Session(object):
 
         self._njobs_submitted += njobs
         qondor.utils.create_directory(self.rundir)
-        cluster.rundir = self.rundir
+        # List the rundir once, rather than checking for every job file
+        if self._rundir_contents_path != self.rundir:
+            self._rundir_contents = (
+                set(os.listdir(self.rundir)) if osp.isdir(self.rundir) else set()
+            )
+            self._rundir_contents_path = self.rundir
+        cluster.set_rundir(self.rundir, self._rundir_contents)
         # Possibly create tarballs out of required python packages
         self.handle_python_package_tarballs(cluster)
         # Possibly create tarball for the seutils cache and include it in the job
         # if seutils.USE_CACHE:
         #     cluster.transfer_files["seutils-cache"] = self.dump_seutils_cache()
         # Dump cluster contents to file and build scope
-        cluster.runcode_to_file()
-        cluster.sh_entrypoint_to_file()
-        cluster.scope_to_file()
+        # The writes themselves happen in threads if possible
+        if self._io_pool is None and ThreadPoolExecutor is not None:
+            self._io_pool = ThreadPoolExecutor(max_workers=8)
+        self._pending_writes.extend(cluster.dump_all(self._io_pool))
         # Compile the submission dict
         # Base off of global settings only for python-binding mode
         # For the condor_submit cli method, it's better to just write the global keys once at the top of the file
@@ -386,32 +597,47 @@ class Session(object):
             "error": "err_{}_$(Cluster)_$(Process).txt".format(cluster.name),
             "log": "log_{}_$(Cluster)_$(Process).txt".format(cluster.name),
         }
-        sub["executable"] = osp.abspath(cluster.sh_entrypoint_filename)
+        sub["executable"] = cluster.sh_entrypoint_path
         sub["environment"] = {}
         sub["environment"]["QONDORICLUSTER"] = str(cluster.i_cluster)
         sub["environment"]["QONDORCLUSTERNAME"] = str(cluster.name)
         sub["environment"].update(cluster.env)
-        # Overwrite htcondor keys defined in the preprocessing
-        sub.update(cluster.htcondor)
         # Flatten files into a string, excluding files on storage elements
-        transfer_files = self.transfer_files + [
-            f for f in cluster.transfer_files.values() if not seutils.path.has_protocol(f)
-        ]
-        if len(transfer_files) > 0:
-            sub["transfer_input_files"] = ",".join(transfer_files)
+        # (paths with a protocol; the same check as seutils.path.has_protocol)
+        transfer_files = ",".join(
+            itertools.chain(
+                self.transfer_files,
+                (f for f in cluster.transfer_files.values() if "://" not in f),
+            )
+        )
+        if transfer_files:
+            sub["transfer_input_files"] = transfer_files
+        # Overwrite htcondor keys defined for the cluster; environment and
+        # transfer_input_files are merged rather than overwritten
         sub = update_sub(sub, cluster.htcondor)
         # Plugin the global and cmsconnect settings in now
         self.fix_cmsconnect_specific_settings_once(cli)
         sub = update_sub(self.htcondor_settings, sub)
-        logger.info(
-            "Prepared submission dict for cluster %s:\n%s",
-            cluster.i_cluster,
-            pprint.pformat(sub),
-        )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Prepared submission dict for cluster %s:\n%s",
+                cluster.i_cluster,
+                pprint.pformat(sub),
+            )
         # Add it to the submittables
-        self.submittables.append((sub, njobs))
+        self.add_submittable(sub, njobs)
+
+    def add_submittable(self, sub, njobs):
+        """
+        Queues a submission dict for submission. The environment is formatted
+        for htcondor here, once, for use by either submit method.
+        """
+        self.submittables.append(
+            (sub, njobs, self.format_environment(sub["environment"]))
+        )
 
     def submit_pythonbindings(self, njobsmax=None):
+        self.wait_for_writes()
         qondor.utils.check_proxy()
         if not self.submittables:
             return
@@ -419,7 +645,7 @@ class Session(object):
 
         if njobsmax is None:
             njobsmax = 1e7
-        n_jobs_summed = sum([njobs for _, njobs in self.submittables])
+        n_jobs_summed = sum([njobs for _, njobs, _ in self.submittables])
         n_jobs_total = min(n_jobs_summed, njobsmax)
         logger.info("Submitting all jobs; %s out of %s", n_jobs_total, n_jobs_summed)
         schedd = qondor.schedd.get_best_schedd()
@@ -428,18 +654,15 @@ class Session(object):
         with qondor.utils.switchdir(self.rundir):
             with qondor.schedd._transaction(schedd) as transaction:
                 submit_object = htcondor.Submit()
-                for sub_orig, njobs in self.submittables:
-                    sub = (
-                        sub_orig.copy()
-                    )  # Keep original dict intact? Global settings already contained
-                    sub["environment"] = qondor.schedd.format_env_htcondor(
-                        sub["environment"]
-                    )
+                for sub_orig, njobs, environment in self.submittables:
                     njobs = min(njobs, n_jobs_todo)
                     n_jobs_todo -= njobs
-                    # Load the dict into the submit object
-                    for key in sub:
-                        submit_object[key] = sub[key]
+                    # Load the dict into the submit object, using the formatted
+                    # environment; the original dict is kept intact
+                    for key, val in sub_orig.items():
+                        submit_object[key] = (
+                            environment if key == "environment" else val
+                        )
                     new_ads = []
                     cluster_id = (
                         int(submit_object.queue(transaction, njobs, new_ads))
@@ -469,12 +692,13 @@ class Session(object):
         )
 
     def submit_cli(self, njobsmax=None):
+        self.wait_for_writes()
         qondor.utils.check_proxy()
         if not self.submittables:
             return
         if njobsmax is None:
             njobsmax = 1e7
-        n_jobs_summed = sum([njobs for _, njobs in self.submittables])
+        n_jobs_summed = sum([njobs for _, njobs, _ in self.submittables])
         n_jobs_total = min(n_jobs_summed, njobsmax)
         logger.info("Submitting all jobs; %s out of %s", n_jobs_total, n_jobs_summed)
         n_jobs_todo = n_jobs_total
@@ -490,23 +714,23 @@ class Session(object):
                 get_cluster_nr(self.submittables[-1][0]),
             ),
         )
-        jdl_contents = []
-        # Write the settings per job
-        for sub, njobs in self.submittables:
+        # Determine which clusters (and how many jobs of each) go in the file
+        to_submit = []
+        for sub, njobs, environment in self.submittables:
             njobs = min(njobs, n_jobs_todo)
             n_jobs_todo -= njobs
-            jdl_contents.append(
-                "# Cluster {}".format(sub["environment"]["QONDORICLUSTER"])
-            )
-            # Dump the submission to a jdl file
-            for key in sub.keys():
-                val = sub[key]
-                if key.lower() == "environment":
-                    val = qondor.schedd.format_env_htcondor(val)
-                jdl_contents.append("{} = {}".format(key, val))
-            jdl_contents.append("queue {}\n".format(njobs))
+            to_submit.append((sub, njobs, environment))
             if n_jobs_todo == 0:
                 break
+        # Write the settings shared by all clusters once, then the rest per cluster
+        common = get_common_jdl_settings([sub for sub, _, _ in to_submit])
+        jdl_contents = ["# Common settings"]
+        jdl_contents.extend("{} = {}".format(key, val) for key, val in common.items())
+        jdl_contents.append("")
+        jdl_contents.extend(
+            format_jdl_block(sub, njobs, environment, common)
+            for sub, njobs, environment in to_submit
+        )
         # Dump to file
         jdl_contents = "\n".join(jdl_contents)
         with qondor.utils.openfile(jdl_file, "w") as jdl:
@@ -519,9 +743,11 @@ class Session(object):
         if qondor.DRYMODE:
             logger.warning("Summary: Submitted %s jobs to cluster 0", n_jobs_total)
         else:
-            matches = re.findall(
-                r"(\d+) job\(s\) submitted to cluster (\d+)", "\n".join(output)
-            )
+            matches = [
+                match
+                for line in output
+                for match in _CONDOR_SUBMIT_OUTPUT_RE.findall(line)
+            ]
             if not len(matches):
                 logger.error(
                     "condor_submit exited ok but could not determine where and how many jobs were submitted"
@@ -536,13 +762,28 @@ class Session(object):
                 )
                 njobs_assigned = 0
                 while njobs_assigned < njobs_submitted:
-                    sub, njobs_thissub = next(submittables)  # Get the next sub
+                    sub, njobs_thissub, _ = next(submittables)  # Get the next sub
                     proc_ids = list(
                         range(njobs_assigned, njobs_assigned + njobs_thissub)
                     )  # Build the list of proc_ids
                     njobs_assigned += njobs_thissub
                     self.submitted.append((sub, cluster_id, njobs_assigned, proc_ids))
 
+    def wait_for_writes(self):
+        """
+        Blocks until all job files are written; raises if a write failed.
+        Shuts down the write threads; add_submission starts new ones if needed.
+        """
+        pending_writes = self._pending_writes
+        self._pending_writes = []
+        try:
+            for future in pending_writes:
+                future.result()
+        finally:
+            if self._io_pool is not None:
+                self._io_pool.shutdown(wait=True)
+                self._io_pool = None
+
     def submit(self, cli, *args, **kwargs):
         """
         Wrapper that just picks the specific submit method
@@ -582,9 +823,12 @@ class Session(object):
             return submission
 
 
+# Counter for the i_cluster of every Cluster instance
+_CLUSTER_COUNTER = itertools.count()
+
+
 class Cluster(object):
 
-    ICLUSTER = 0
     NAMES = set()
 
     def __init__(
@@ -601,14 +845,16 @@ class Cluster(object):
         transfer_files=None,
         **kwargs
     ):
-        self.i_cluster = self.__class__.ICLUSTER
-        self.__class__.ICLUSTER += 1
-        self.rundir = rundir
+        self.i_cluster = next(_CLUSTER_COUNTER)
         self.runcode = runcode
         self.env = {} if env is None else env
         self.scope = {} if scope is None else scope
         self.htcondor = {} if htcondor is None else htcondor
         self.run_args = run_args
+        # Arguments for the python script, quoted for the .sh entrypoint
+        self._quoted_run_args = (
+            " ".join([quote(s) for s in run_args]) if run_args else ""
+        )
 
         # Figure out the run environment
         self._is_conda_pack = False
@@ -660,30 +906,20 @@ class Cluster(object):
         self.runcode_filename = "{}.py".format(self.name)
         self.sh_entrypoint_filename = "{}.sh".format(self.name)
         self.scope_filename = "{}.json".format(self.name)
+        self.set_rundir(rundir)
         # Process pip packages
         self.pips = []
-        pips = [] if pips is None else pips
-
-        def check_if_in_pips(package):
-            """Checks if a package is already in the list"""
-            package, _ = qondor.utils.pip_split_version(package)
-            for pip in pips:
-                if not qondor.utils.is_string(pip):
-                    pip = pip[0]
-                pip, _ = qondor.utils.pip_split_version(pip)
-                if pip == package:
-                    return True
-            return False
-
-        if not check_if_in_pips("qondor"):
-            pips.append(("qondor=={}".format(qondor.version), "auto"))
-        if not check_if_in_pips("seutils"):
-            pips.append(("seutils", "auto"))
-        for pip in pips:
+        for pip in [] if pips is None else pips:
             if qondor.utils.is_string(pip):
                 self.pips.append((pip, "auto"))
             else:
                 self.pips.append((pip[0], pip[1]))
+        # Add qondor and seutils, unless they were already specified
+        pip_names = set(qondor.utils.pip_split_version(pip)[0] for pip, _ in self.pips)
+        if "qondor" not in pip_names:
+            self.pips.append(("qondor=={}".format(qondor.version), "auto"))
+        if "seutils" not in pip_names:
+            self.pips.append(("seutils", "auto"))
         # Add addtional keywords to the scope
         self.scope.update(kwargs)
 
@@ -712,94 +948,102 @@ class Cluster(object):
                     raise Exception("Could not make a unique key")
         self.transfer_files[key] = filename
 
-    def runcode_to_file(self):
-        self.runcode_filename = osp.join(self.rundir, self.runcode_filename)
-        if osp.isfile(self.runcode_filename):
-            raise OSError("{} exists".format(self.runcode_filename))
-        self.transfer_files["runcode"] = self.runcode_filename
+    def set_rundir(self, rundir, rundir_contents=None):
+        """
+        Sets the directory to which the job files are dumped, and the full paths
+        of the job files in it.
+        rundir_contents may be a set of the filenames already in rundir, in which
+        case it is used (and updated) instead of checking the filesystem for
+        every job file.
+        """
+        self.rundir = rundir
+        self._rundir_contents = rundir_contents
+        self.runcode_path = osp.join(rundir, self.runcode_filename)
+        self.sh_entrypoint_path = osp.join(rundir, self.sh_entrypoint_filename)
+        self.scope_path = osp.join(rundir, self.scope_filename)
+
+    def _claim_job_file(self, filename, path):
+        """
+        Raises an OSError if a job file already exists in the rundir
+        """
+        if self._rundir_contents is None:
+            if osp.isfile(path):
+                raise OSError("{} exists".format(path))
+        elif filename in self._rundir_contents:
+            raise OSError("{} exists".format(path))
+        else:
+            self._rundir_contents.add(filename)
+
+    def _write_job_file(self, path, contents, mode="w", executor=None):
+        """
+        Writes contents to a job file, or schedules the write on executor
+        if given (returning the future). Does nothing in dry mode.
+        """
+        if qondor.DRYMODE:
+            return None
+        if executor is not None:
+            return executor.submit(write_file, path, contents, mode)
+        write_file(path, contents, mode)
+
+    def runcode_to_file(self, executor=None):
+        self._claim_job_file(self.runcode_filename, self.runcode_path)
+        self.transfer_files["runcode"] = self.runcode_path
         logger.info(
             "Dumping python code for cluster %s to %s",
             self.i_cluster,
-            self.runcode_filename,
+            self.runcode_path,
         )
-        if not (qondor.DRYMODE):
-            with open(self.runcode_filename, "w") as f:
-                f.write(self.runcode)
-
-    def sh_entrypoint_to_file(self):
-        self.sh_entrypoint_filename = osp.join(self.rundir, self.sh_entrypoint_filename)
-        if osp.isfile(self.sh_entrypoint_filename):
-            raise OSError("{} exists".format(self.sh_entrypoint_filename))
+        return self._write_job_file(self.runcode_path, self.runcode, executor=executor)
+
+    def sh_entrypoint_to_file(self, executor=None):
+        self._claim_job_file(self.sh_entrypoint_filename, self.sh_entrypoint_path)
         sh = self.parse_sh_entrypoint()
-        self.transfer_files["sh_entrypoint"] = self.sh_entrypoint_filename
+        self.transfer_files["sh_entrypoint"] = self.sh_entrypoint_path
         logger.info(
             "Dumping .sh entrypoint for cluster %s to %s",
             self.i_cluster,
-            self.sh_entrypoint_filename,
+            self.sh_entrypoint_path,
         )
-        if not (qondor.DRYMODE):
-            with open(self.sh_entrypoint_filename, "w") as f:
-                f.write(sh)
-
-    def scope_to_file(self):
-        self.scope_filename = osp.join(self.rundir, self.scope_filename)
-        if osp.isfile(self.scope_filename):
-            raise OSError("{} exists".format(self.scope_filename))
-        self.transfer_files["scope"] = self.scope_filename
-        self.env["QONDORSCOPEFILE"] = osp.basename(self.scope_filename)
+        return self._write_job_file(self.sh_entrypoint_path, sh, executor=executor)
+
+    def scope_to_file(self, executor=None):
+        self._claim_job_file(self.scope_filename, self.scope_path)
+        self.transfer_files["scope"] = self.scope_path
+        self.env["QONDORSCOPEFILE"] = self.scope_filename
         # Some last-minute additions before sending to a file
         self.scope["transfer_files"] = self.transfer_files
         self.scope["pips"] = self.pips
+        # Serialize now, so later changes to the scope do not end up in the file
+        scope = json.dumps(self.scope, separators=(",", ":"))
         logger.info(
-            "Dumping the following scope for cluster %s to %s:\n%s",
+            "Dumping scope for cluster %s to %s (%s bytes)",
             self.i_cluster,
-            self.scope_filename,
-            pprint.pformat(self.scope),
+            self.scope_path,
+            len(scope),
         )
-        if not (qondor.DRYMODE):
-            with open(self.scope_filename, "w") as f:
-                json.dump(self.scope, f)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Scope for cluster %s:\n%s",
+                self.i_cluster,
+                scope,
+            )
+        return self._write_job_file(self.scope_path, scope, executor=executor)
 
-    def parse_sh_entrypoint(self):
-        # Basic setup: Divert almost all output to the stderr, and setup cms scripts
-        sh = [
-            "#!/bin/bash",
-            "set -e",
-            'echo "hostname: $(hostname)"',
-            'echo "date:     $(date)"',
-            'echo "pwd:      $(pwd)"',
-            'echo "ls -al:"',
-            "ls -al",
-            'echo "Redirecting all output to stderr from here on out"',
-            "exec 1>&2",
-            "",
-            "export VO_CMS_SW_DIR=/cvmfs/cms.cern.ch/",
-            "source /cvmfs/cms.cern.ch/cmsset_default.sh",
-            "env > bare_env.txt",  # Save the environment before doing any other environment setup
-            "",
+    def dump_all(self, executor=None):
+        """
+        Dumps the python code, the .sh entrypoint and the scope (in that order,
+        as the scope lists the other files) to the rundir.
+        Returns the futures of the writes that were scheduled on executor.
+        """
+        futures = [
+            self.runcode_to_file(executor),
+            self.sh_entrypoint_to_file(executor),
+            self.scope_to_file(executor),
         ]
-        # Set the runtime environment (typically sourcing scripts to get the right python/gcc/ROOT/etc.)
-        sh += self.run_env + [""]
-        sh += ["set -uxoE pipefail"]
-
-        if not self._is_conda_pack:
-            # Set up a directory to install python packages in, and put on the path
-            # Currently requires $pipdir to be defined... might want to figure out something more clever
-            sh += [
-                'echo "Setting up custom pip install dir"',
-                'HOME="$(pwd)"',
-                'export pip_install_dir="$(pwd)/install"',
-                'export PATH="${pip_install_dir}/bin:${PATH}"',
-                "export PYTHONVERSION=$(python -c \"import sys; print('{}.{}'.format(sys.version_info.major, sys.version_info.minor))\")",
-                'export PYTHONPATH="${pip_install_dir}/lib/python${PYTHONVERSION}/site-packages:${PYTHONPATH}"',
-                'mkdir -p "${pip_install_dir}/bin"',
-                'mkdir -p "${pip_install_dir}/lib/python${PYTHONVERSION}/site-packages"',
-                "",
-                "pip -V",
-                "which pip",
-                "",
-            ]
+        return [future for future in futures if future is not None]
 
+    def parse_sh_entrypoint(self):
+        sh = [get_sh_preamble(self.run_env, self._is_conda_pack)]
         if self._is_conda_pack:
             pip_install_options = "--no-cache-dir --no-use-pep517"
         else:
@@ -835,19 +1079,11 @@ class Cluster(object):
         # Make the actual python call to run the required job code
         # Also echo the exitcode of the python command to a file, to easily check whether jobs succeeded
         # First compile the command - which might take some command line arguments
-        python_cmd = "python {0}".format(osp.basename(self.runcode_filename))
-        if self.run_args:
+        python_cmd = "python {0}".format(self.runcode_filename)
+        if self._quoted_run_args:
             # Add any arguments for the python script to this line
-            try:  # py3
-                from shlex import quote
-            except ImportError:  # py2
-                from pipes import quote
-            python_cmd += " " + " ".join([quote(s) for s in self.run_args])
-        sh += [
-            python_cmd,
-            'echo "$?" > exitcode_${QONDORCLUSTERNAME}_${CONDOR_CLUSTER_NUMBER}_${CONDOR_PROCESS_ID}.txt',  # Store the python exit code in a file
-            "",
-        ]
+            python_cmd += " " + self._quoted_run_args
+        sh += [python_cmd, _SH_FOOTER]
         sh = "\n".join(sh)
         logger.info(
             "Parsed the following .sh entrypoint for cluster %s:\n%s",
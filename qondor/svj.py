@@ -2,15 +2,28 @@
 Module specific for the (boosted) svj analysis
 """
 
+import hashlib
+import json
 import logging
 import os
 import os.path as osp
 import pprint
+import random
+import re
+import shutil
 import subprocess
+import threading
+import time
+
+try:  # py3
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # py2 without the futures backport; check paths serially
+    ThreadPoolExecutor = None
 
 import seutils
 
 import qondor
+import qondor.utils
 
 logger = logging.getLogger("qondor")
 
@@ -62,10 +75,27 @@ class Physics(dict):
         return pprint.pformat(dict(self))
 
 
+# Cache of filenames per step and physics; see svj_filename
+# Bounded, since every physics point ever passed in would otherwise stay in it
+_SVJ_FILENAME_CACHE = qondor.utils.LRUCache(256)
+_SVJ_FILENAME_KEYS = ("mz", "mdark", "rinv", "alpha", "boost", "max_events", "part")
+
+
 def svj_filename(step, physics):
     """
     Returns a basename for a root file that is input or output of a given step for given physics
     """
+    # Key on type and value, since e.g. rinv=1 and rinv=1.0 format differently
+    try:
+        key = (step,) + tuple(
+            (type(physics.get(k)), physics.get(k)) for k in _SVJ_FILENAME_KEYS
+        )
+        return _SVJ_FILENAME_CACHE[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable physics values; just don't cache
+        key = None
     rootfile = (
         "{step}_s-channel_mMed-{mz:.0f}_mDark-{mdark:.0f}_rinv-{rinv}_"
         "alpha-{alpha}{boost_str}_13TeV-madgraphMLM-pythia8{max_events_str}.root".format(
@@ -77,15 +107,37 @@ def svj_filename(step, physics):
     )
     if physics.get("part", None):
         rootfile = rootfile.replace(".root", "_part-{}.root".format(physics["part"]))
+    if key is not None:
+        _SVJ_FILENAME_CACHE[key] = rootfile
     return rootfile
 
 
 def madgraph_tarball_filename(physics):
     """Returns the basename of a MadGraph tarball for the given physics"""
-    # Madgraph tarball filenames do not have a part number associated with them; overwrite it
-    return svj_filename("step0_GRIDPACK", Physics(physics, part=None)).replace(
-        ".root", ".tar.xz"
-    )
+    # Madgraph tarball filenames do not have a part number associated with them; overwrite it.
+    # No need to copy if there is no part number to begin with.
+    if not (isinstance(physics, Physics) and physics.get("part", None) is None):
+        physics = Physics(physics, part=None)
+    return svj_filename("step0_GRIDPACK", physics).replace(".root", ".tar.xz")
+
+
+# Basenames of the files in each MadGraph tarball path, listed at most once per process
+_MG_LISTING_CACHE = {}
+
+
+def mg_tarball_exists(src):
+    """
+    Checks whether a tarball exists on the SE, using a cached listing of its
+    directory. Falls back to a plain isfile check if the directory cannot be listed.
+    """
+    path, basename = osp.split(src)
+    if path not in _MG_LISTING_CACHE:
+        try:
+            _MG_LISTING_CACHE[path] = set(osp.basename(f) for f in seutils.ls(path))
+        except Exception as e:
+            logger.debug("Could not list %s (%s); checking %s directly", path, e, src)
+            return seutils.isfile(src)
+    return basename in _MG_LISTING_CACHE[path]
 
 
 def download_madgraph_tarball(physics, dst=None):
@@ -97,15 +149,19 @@ def download_madgraph_tarball(physics, dst=None):
         logger.info("File %s already exists", dst)
     else:
         if len(MG_TARBALL_PATHS) == 0: use_ul_mgtarballs()
-        for mg_tarball_path in MG_TARBALL_PATHS:
-            # Tarballs on SE will not have the boost tag and have postfix "_n-1"
-            src = osp.join(
-                mg_tarball_path,
-                madgraph_tarball_filename(
-                    Physics(physics, boost=0.0, max_events=1, part=None)
-                ),
-            )
-            if seutils.isfile(src):
+        # Tarballs on SE will not have the boost tag and have postfix "_n-1"
+        tarball = madgraph_tarball_filename(
+            Physics(physics, boost=0.0, max_events=1, part=None)
+        )
+        srcs = [osp.join(path, tarball) for path in MG_TARBALL_PATHS]
+        # Check all locations at once; the first existing one in the list is used
+        if len(srcs) > 1 and ThreadPoolExecutor is not None:
+            with ThreadPoolExecutor(max_workers=len(srcs)) as executor:
+                exists = list(executor.map(mg_tarball_exists, srcs))
+        else:
+            exists = [mg_tarball_exists(src) for src in srcs]
+        for src, src_exists in zip(srcs, exists):
+            if src_exists:
                 logger.info("Downloading %s --> %s", src, dst)
                 seutils.cp(src, dst)
                 break
@@ -117,47 +173,75 @@ def download_madgraph_tarball(physics, dst=None):
             )
 
 
+_STEP_CMD_TEMPLATE = (
+    "cmsRun runSVJ.py"
+    " year={year}"
+    " madgraph=1"
+    " channel=s"
+    " outpre={outpre}"
+    " config={outpre}"
+    " part={part}"
+    " mMediator={mz:.0f}"
+    " mDark={mdark:.0f}"
+    " rinv={rinv}"
+    " inpre={inpre}"
+)
+
+_GRIDPACK_CMD_TEMPLATE = (
+    "python runMG.py"
+    " year={year}"
+    " madgraph=1"
+    " channel=s"
+    " outpre=step0_GRIDPACK"
+    " mMediator={mz:.0f}"
+    " mDark={mdark:.0f}"
+    " rinv={rinv}"
+)
+
+
 def step_cmd(inpre, outpre, physics):
-    cmd = (
-        "cmsRun runSVJ.py"
-        " year={year}"
-        " madgraph=1"
-        " channel=s"
-        " outpre={outpre}"
-        " config={outpre}"
-        " part={part}"
-        " mMediator={mz:.0f}"
-        " mDark={mdark:.0f}"
-        " rinv={rinv}"
-        " inpre={inpre}".format(inpre=inpre, outpre=outpre, **physics)
-    )
+    parts = [_STEP_CMD_TEMPLATE.format(inpre=inpre, outpre=outpre, **physics)]
     if "mingenjetpt" in physics:
-        cmd += " mingenjetpt={0:.1f}".format(physics["mingenjetpt"])
+        parts.append("mingenjetpt={0:.1f}".format(physics["mingenjetpt"]))
     if "boost" in physics:
-        cmd += " boost={0:.0f}".format(physics["boost"])
+        parts.append("boost={0:.0f}".format(physics["boost"]))
     if "max_events" in physics:
-        cmd += " maxEvents={0}".format(physics["max_events"])
-    return cmd
+        parts.append("maxEvents={0}".format(physics["max_events"]))
+    return " ".join(parts)
 
 
 def gridpack_cmd(physics, nogridpack=False):
-    cmd = (
-        "python runMG.py"
-        " year={year}"
-        " madgraph=1"
-        " channel=s"
-        " outpre=step0_GRIDPACK"
-        " mMediator={mz:.0f}"
-        " mDark={mdark:.0f}"
-        " rinv={rinv}".format(**physics)
-    )
+    parts = [_GRIDPACK_CMD_TEMPLATE.format(**physics)]
     if physics["boost"] > 0.0:
-        cmd += " boost={}".format(physics["boost"])
+        parts.append("boost={}".format(physics["boost"]))
     if physics["max_events"] > 0.0:
-        cmd += " maxEvents={}".format(physics["max_events"])
+        parts.append("maxEvents={}".format(physics["max_events"]))
     if nogridpack:
-        cmd += " nogridpack=1"
-    return cmd
+        parts.append("nogridpack=1")
+    return " ".join(parts)
+
+
+def move_or_copy(src, dst, move=False):
+    """
+    Moves or copies src to dst. Local files are handled by shutil, which
+    lets the kernel do the copying where possible, and moves fall back to a
+    copy if src and dst are on different filesystems. Remote files are copied
+    with seutils.
+    """
+    if seutils.path.has_protocol(src):
+        if move:
+            raise ValueError("Cannot move remote file {0}".format(src))
+        seutils.cp(src, dst)
+    elif move:
+        logger.info("Moving %s -> %s", src, dst)
+        shutil.move(src, dst)
+    else:
+        logger.info("Copying %s -> %s", src, dst)
+        shutil.copyfile(src, dst)
+
+
+# Seconds to wait before retrying a failed step, per attempt
+RUN_STEP_RETRY_DELAYS = [30, 60, 120, 240]
 
 
 class CMSSW(qondor.cmssw.CMSSW):
@@ -170,15 +254,15 @@ class CMSSW(qondor.cmssw.CMSSW):
     def download_madgraph_tarball(self, physics):
         download_madgraph_tarball(physics, dst=self.svj_path)
 
-    def _run_step(self, inpre, outpre, physics):
-        """Runs the runSVJ script for 1 step"""
-        expected_infile = osp.join(
-            self.svj_path,
-            madgraph_tarball_filename(physics)
-            if inpre.startswith("step0")
-            else svj_filename(inpre, physics),
-        )
-        expected_outfile = osp.join(self.svj_path, svj_filename(outpre, physics))
+    def _run_step(self, inpre, outpre, physics, paths=None):
+        """
+        Runs the runSVJ script for 1 step.
+        paths optionally maps step names to precomputed file paths (see run_chain).
+        """
+        if paths is None:
+            paths = self.get_step_paths([inpre, outpre], physics)
+        expected_infile = paths[inpre]
+        expected_outfile = paths[outpre]
         if not osp.isfile(expected_infile):
             raise RuntimeError(
                 "Expected input file {0} should exist now for step {1} -> {2}".format(
@@ -190,7 +274,22 @@ class CMSSW(qondor.cmssw.CMSSW):
         )
         return expected_outfile
 
-    def run_step(self, inpre, outpre, physics, n_attempts=1):
+    def get_step_paths(self, steps, physics):
+        """
+        Returns a dict of step name -> path of the rootfile (or MadGraph
+        tarball for step0) in the svj_path for the given physics
+        """
+        return {
+            step: osp.join(
+                self.svj_path,
+                madgraph_tarball_filename(physics)
+                if step.startswith("step0")
+                else svj_filename(step, physics),
+            )
+            for step in steps
+        }
+
+    def run_step(self, inpre, outpre, physics, n_attempts=1, paths=None):
         """Wrapper around self._run_step with an n_attempts option"""
         i_attempt = 1
         while True:
@@ -202,7 +301,7 @@ class CMSSW(qondor.cmssw.CMSSW):
                     i_attempt,
                     n_attempts,
                 )
-                expected_outfile = self._run_step(inpre, outpre, physics)
+                expected_outfile = self._run_step(inpre, outpre, physics, paths=paths)
                 return expected_outfile
             except subprocess.CalledProcessError:
                 logger.error(
@@ -214,12 +313,17 @@ class CMSSW(qondor.cmssw.CMSSW):
                     )
                     raise
                 else:
+                    # Back off exponentially, with some jitter so that many jobs
+                    # failing at the same time do not all retry at once
+                    delay = RUN_STEP_RETRY_DELAYS[
+                        min(i_attempt, len(RUN_STEP_RETRY_DELAYS)) - 1
+                    ] * random.uniform(0.8, 1.2)
                     logger.error(
-                        "This was attempt %s; Sleeping 60s and retrying", i_attempt
+                        "This was attempt %s; Sleeping %.0fs and retrying",
+                        i_attempt,
+                        delay,
                     )
-                    from time import sleep
-
-                    sleep(60)
+                    time.sleep(delay)
                     i_attempt += 1
 
     def run_chain(self, chain, physics, rootfile=None, move=False):
@@ -230,14 +334,19 @@ class CMSSW(qondor.cmssw.CMSSW):
         """
         inpres = chain[:-1]
         outpres = chain[1:]
+        # Compute all paths of the chain once, rather than per step
+        paths = self.get_step_paths(chain, physics)
         # Copy/move the input rootfile if it's given
         if rootfile:
-            expected_infile = osp.join(self.svj_path, svj_filename(inpres[0], physics))
-            if move:
-                logger.info("Moving %s -> %s", rootfile, expected_infile)
-                os.rename(rootfile, expected_infile)
+            if inpres[0].startswith("step0"):
+                # step0 starts from the MadGraph tarball; there is no input rootfile
+                logger.warning(
+                    "Chain starts at %s, which takes no input rootfile; ignoring %s",
+                    inpres[0],
+                    rootfile,
+                )
             else:
-                seutils.cp(rootfile, expected_infile)
+                move_or_copy(rootfile, paths[inpres[0]], move=move)
         # Run steps
         for inpre, outpre in zip(inpres, outpres):
             expected_outfile = self.run_step(
@@ -245,6 +354,7 @@ class CMSSW(qondor.cmssw.CMSSW):
                 outpre,
                 physics,
                 n_attempts=3 if ("RECO" in outpre or "DIGI" in outpre) else 1,
+                paths=paths,
             )
         return expected_outfile
 
@@ -263,16 +373,7 @@ class CMSSW(qondor.cmssw.CMSSW):
         """
         Runs the python to make the tarball
         """
-        cmd = (
-            "python runMG.py"
-            " year={year}"
-            " madgraph=1"
-            " channel=s"
-            " outpre=step0_GRIDPACK"
-            " mMediator={mz:.0f}"
-            " mDark={mdark:.0f}"
-            " rinv={rinv}".format(**physics)
-        )
+        cmd = _GRIDPACK_CMD_TEMPLATE.format(**physics)
         self.run_commands(["cd {0}".format(self.svj_path), cmd])
         return osp.join(
             self.svj_path,
@@ -282,10 +383,83 @@ class CMSSW(qondor.cmssw.CMSSW):
         )
 
 
+# On-disk cache of TreeMaker readFiles, shared between processes on the same machine
+READFILES_CACHE_DIR = osp.join(
+    os.environ.get("XDG_CACHE_HOME", osp.expanduser("~/.cache")), "qondor", "readfiles"
+)
+READFILES_CACHE_MAX_AGE = 7 * 24 * 3600  # seconds
+
+# Matches the MC rootfiles listed in a TreeMaker _cff.py file
+_STORE_MC_RE = re.compile(r"/store/mc.*?root")
+
+
+def _readfiles_cache_path(bkg):
+    return osp.join(
+        READFILES_CACHE_DIR, hashlib.sha1(bkg.encode("utf-8")).hexdigest() + ".json"
+    )
+
+
+def load_readfiles_from_disk(bkg):
+    """
+    Returns the cached entry for bkg from disk as a dict with keys
+    'rootfiles', 'etag' and 'age' (in seconds), or None if there is no cache entry
+    """
+    path = _readfiles_cache_path(bkg)
+    try:
+        age = time.time() - os.stat(path).st_mtime
+        with open(path, "r") as f:
+            entry = json.load(f)
+    except (OSError, IOError, ValueError):
+        return None
+    if isinstance(entry, list):
+        # Older cache entries only stored the rootfiles
+        entry = {"rootfiles": entry, "etag": None}
+    entry["age"] = age
+    return entry
+
+
+def dump_readfiles_to_disk(bkg, rootfiles, etag=None):
+    """
+    Stores the readFiles for bkg on disk, together with the etag of the
+    downloaded _cff.py file. Failures are not fatal; the files will just be
+    downloaded again next time.
+    """
+    path = _readfiles_cache_path(bkg)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        if not osp.isdir(READFILES_CACHE_DIR):
+            os.makedirs(READFILES_CACHE_DIR)
+        with open(tmp, "w") as f:
+            json.dump({"rootfiles": rootfiles, "etag": etag}, f)
+        os.rename(tmp, path)  # Atomic, so concurrent jobs never read a partial file
+    except (OSError, IOError) as e:
+        logger.debug("Could not cache readFiles for %s: %s", bkg, e)
+
+
+_BKG_CMD_TEMPLATE = (
+    "cmsRun runMakeTreeFromMiniAOD_cfg.py"
+    " outfile=outfile"
+    " scenario={}"
+    " inputFilesConfig={}"
+    " lostlepton=0"
+    " doZinv=0"
+    " systematics=0"
+    " deepAK8=0"
+    " deepDoubleB=0"
+    " doPDFs=0"
+    " nestedVectors=False"
+    " splitLevel=99"
+    " nstart={}"
+    " nfiles=1"
+)
+
+
 class TreeMakerCMSSW(qondor.cmssw.CMSSW):
     """Subclass of the main CMSSW class for SVJ"""
 
     _readfiles_cache = {}
+    _readfiles_locks = {}
+    _readfiles_locks_lock = threading.Lock()
 
     def __init__(self, *args, **kwargs):
         super(TreeMakerCMSSW, self).__init__(*args, **kwargs)
@@ -295,21 +469,43 @@ class TreeMakerCMSSW(qondor.cmssw.CMSSW):
     def get_readfiles(cls, bkg):
         """
         Hacky: gets the readFiles from the main TreeMaker repo.
-        Caches results in class variable so subsequent calls just use the cache
+        Caches results in class variable so subsequent calls just use the cache,
+        and on disk so other processes do not need to download them again.
+        Safe to call from multiple threads; a bkg is only retrieved once, and
+        different bkgs are retrieved in parallel.
         """
-        if bkg in cls._readfiles_cache:
+        try:
             return cls._readfiles_cache[bkg]
-        import re
-
+        except KeyError:
+            pass
+        # One lock per bkg, so a download only blocks threads asking for that bkg
+        with cls._readfiles_locks_lock:
+            lock = cls._readfiles_locks.setdefault(bkg, threading.Lock())
+        with lock:
+            # Another thread may have filled the cache while we waited for the lock
+            if bkg not in cls._readfiles_cache:
+                cls._readfiles_cache[bkg] = cls._retrieve_readfiles(bkg)
+        return cls._readfiles_cache[bkg]
+
+    @staticmethod
+    def _retrieve_readfiles(bkg):
+        """Gets the readFiles from the disk cache, or downloads them if needed"""
+        entry = load_readfiles_from_disk(bkg)
+        if entry is not None and entry["age"] <= READFILES_CACHE_MAX_AGE:
+            return entry["rootfiles"]
         scenario, bkg_string = bkg.split(".", 1)
         url = "https://raw.githubusercontent.com/TreeMaker/TreeMaker/Run2_2017/Production/python/{}/{}_cff.py".format(
             scenario, bkg_string
         )
-        text = qondor.utils.strip_comments(qondor.utils.download_url_to_str(url))
-        rootfiles = re.findall(r"/store/mc.*?root", text)
-        cls._readfiles_cache[
-            bkg
-        ] = rootfiles  # Cache result so we can safely call the method again
+        # For an expired cache entry, only download the file again if it changed
+        text, etag = qondor.utils.download_url_to_str_if_modified(
+            url, etag=entry["etag"] if entry else None
+        )
+        if text is None:
+            rootfiles = entry["rootfiles"]
+        else:
+            rootfiles = _STORE_MC_RE.findall(qondor.utils.strip_comments(text))
+        dump_readfiles_to_disk(bkg, rootfiles, etag)
         return rootfiles
 
     @classmethod
@@ -318,25 +514,10 @@ class TreeMakerCMSSW(qondor.cmssw.CMSSW):
 
     def command_bkg(self, bkg, i_file, n_events=None):
         scenario = bkg.split(".")[0]
-        cmd = (
-            "cmsRun runMakeTreeFromMiniAOD_cfg.py"
-            " outfile=outfile"
-            " scenario={}"
-            " inputFilesConfig={}"
-            " lostlepton=0"
-            " doZinv=0"
-            " systematics=0"
-            " deepAK8=0"
-            " deepDoubleB=0"
-            " doPDFs=0"
-            " nestedVectors=False"
-            " splitLevel=99"
-            " nstart={}"
-            " nfiles=1".format(scenario, bkg, i_file)
-        )
+        parts = [_BKG_CMD_TEMPLATE.format(scenario, bkg, i_file)]
         if n_events:
-            cmd += " numevents={}".format(n_events)
-        return cmd
+            parts.append("numevents={}".format(n_events))
+        return " ".join(parts)
 
     def run_bkg(self, *args, **kwargs):
         self.run_commands(
@@ -1,17 +1,26 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import calendar
 import datetime
 import logging
 import math
 import os
 import os.path as osp
 import pprint
+import re
 import shutil
+import stat
 import subprocess
 import sys
 import time
+from collections import OrderedDict
 from contextlib import contextmanager
 
+try:  # py3
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # py2 without the futures backport; create tarballs serially
+    ThreadPoolExecutor = None
+
 import qondor
 
 logger = logging.getLogger("qondor")
@@ -68,9 +77,14 @@ def create_directory(dirname, renew=False, must_not_exist=False, dry=None):
     """
     if dry is None:
         dry = qondor.DRYMODE
-    if osp.isfile(dirname):
+    # One stat call to check both whether it is a file or a directory
+    try:
+        mode = os.stat(dirname).st_mode
+    except OSError:
+        mode = 0
+    if stat.S_ISREG(mode):
         raise OSError("{0} is a file".format(dirname))
-    isdir = osp.isdir(dirname)
+    isdir = stat.S_ISDIR(mode)
 
     if isdir:
         if must_not_exist:
@@ -85,12 +99,21 @@ def create_directory(dirname, renew=False, must_not_exist=False, dry=None):
     _create_directory_no_checks(dirname, dry=dry)
 
 
-def copy_file(src, dst, dry=None):
+def copy_file(src, dst, dry=None, preserve_mode=True):
+    """
+    Copies src to dst, which may be a directory. The copy itself is done by
+    shutil.copyfile, which uses the kernel's fast copy where available; the
+    permission bits are only copied if preserve_mode is True.
+    """
     if dry is None:
         dry = qondor.DRYMODE
     logger.info("Copying %s --> %s", src, dst)
     if not dry:
-        shutil.copy(src, dst)
+        if osp.isdir(dst):
+            dst = osp.join(dst, osp.basename(src))
+        shutil.copyfile(src, dst)
+        if preserve_mode:
+            shutil.copymode(src, dst)
 
 
 class switchdir(object):
@@ -107,7 +130,8 @@ class switchdir(object):
         super(switchdir, self).__init__()
         self.newdir = newdir
         self._backdir = os.getcwd()
-        self._no_need_to_change = self.newdir == self._backdir
+        # Normalize so that e.g. '.', relative paths and trailing slashes compare equal
+        self._no_need_to_change = osp.abspath(self.newdir) == self._backdir
         self.dry = qondor.DRYMODE if dry is None else dry
 
     def __enter__(self):
@@ -126,10 +150,97 @@ class switchdir(object):
             os.chdir(self._backdir)
 
 
-def run_command(cmd, env=None, dry=None, shell=False):
-    logger.warning(
-        "Issuing command: {0}".format(" ".join(cmd) if not is_string(cmd) else cmd)
-    )
+class LRUCache(object):
+    """
+    Small dict-like cache that keeps at most maxsize entries, dropping the
+    least recently used entry when full.
+
+    :param maxsize: Maximum number of entries
+    :type maxsize: int, optional
+    """
+
+    def __init__(self, maxsize=32):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        # Move the entry to the end to mark it as most recently used
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+_DEVNULL = getattr(subprocess, "DEVNULL", None)
+
+
+def get_devnull():
+    """
+    Returns something to pass as stdout/stderr to subprocess to discard output.
+    On python 2 there is no subprocess.DEVNULL; open /dev/null once instead.
+    """
+    global _DEVNULL
+    if _DEVNULL is None:
+        _DEVNULL = open(os.devnull, "w")
+    return _DEVNULL
+
+
+def _decode_output(output):
+    return output if isinstance(output, str) else output.decode("utf-8", "replace")
+
+
+def iter_lines_blockwise(fd, blocksize=65536):
+    """
+    Reads from a file descriptor in blocks of up to blocksize bytes, as soon as
+    output is available, and yields complete lines (including the newline).
+    Avoids a read per line for commands that produce a lot of output.
+    Line endings are normalized like universal_newlines does.
+    """
+    remainder = b""
+    while True:
+        block = os.read(fd, blocksize)
+        if not block:
+            break
+        data = remainder + block
+        # Hold back a trailing carriage return, it may be the first half of a CRLF
+        held = b"\r" if data.endswith(b"\r") else b""
+        if held:
+            data = data[:-1]
+        lines = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n").split(b"\n")
+        remainder = lines.pop() + held
+        for line in lines:
+            yield _decode_output(line + b"\n")
+    if remainder.endswith(b"\r"):
+        yield _decode_output(remainder[:-1] + b"\n")
+    elif remainder:
+        yield _decode_output(remainder)
+
+
+def run_command(cmd, env=None, dry=None, shell=False, cwd=None, capture_output=True):
+    """
+    Runs a command and returns its output as a list of lines.
+    If capture_output is False, stdout is discarded instead of read and logged
+    line by line (stderr is still logged), and an empty list is returned.
+    """
+    if logger.isEnabledFor(logging.WARNING):
+        logger.warning(
+            "Issuing command: %s", " ".join(cmd) if not is_string(cmd) else cmd
+        )
     if dry is None:
         dry = qondor.DRYMODE
     if dry:
@@ -138,20 +249,35 @@ def run_command(cmd, env=None, dry=None, shell=False):
         cmd = " ".join(cmd)
     if env == "clean":
         env = get_clean_env()
-    process = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        env=env,
-        universal_newlines=True,
-        shell=shell,
-    )
+    if capture_output:
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+            shell=shell,
+            cwd=cwd,
+        )
+    else:
+        # Discard stdout, but keep passing stderr through the logger
+        process = subprocess.Popen(
+            cmd,
+            stdout=get_devnull(),
+            stderr=subprocess.PIPE,
+            env=env,
+            shell=shell,
+            cwd=cwd,
+        )
+    pipe = process.stdout if capture_output else process.stderr
 
     output = []
-    for stdout_line in iter(process.stdout.readline, ""):
-        subprocess_logger.info(stdout_line.rstrip("\n"))
-        output.append(stdout_line)
-    process.stdout.close()
+    log_output = subprocess_logger.isEnabledFor(logging.INFO)
+    for line in iter_lines_blockwise(pipe.fileno()):
+        if log_output:
+            subprocess_logger.info(line.rstrip("\n"))
+        if capture_output:
+            output.append(line)
+    pipe.close()
     process.wait()
     returncode = process.returncode
 
@@ -197,25 +323,23 @@ def run_multiple_commands(cmds, env=None, dry=None):
         )
 
     # Break on first error (stdin will still be written but execution will be stopped)
-    process.stdin.write("set -e\n")
-    process.stdin.flush()
-
+    script = ["set -e\n"]
     for cmd in cmds:
         if not (is_string(cmd)):
             cmd = " ".join(cmd)
         if not (cmd.endswith("\n")):
             cmd += "\n"
-        process.stdin.write(cmd)
-        process.stdin.flush()
+        script.append(cmd)
+    # Send the whole script in one write rather than a write and flush per command
+    process.stdin.write("".join(script))
     process.stdin.close()
 
     output = []
-    process.stdout.flush()
-    for line in iter(process.stdout.readline, ""):
-        if len(line) == 0:
-            break
+    log_output = subprocess_logger.isEnabledFor(logging.INFO)
+    for line in iter_lines_blockwise(process.stdout.fileno()):
         line = line.rstrip("\n")
-        subprocess_logger.info(line)
+        if log_output:
+            subprocess_logger.info(line)
         output.append(line)
 
     process.stdout.close()
@@ -229,10 +353,24 @@ def run_multiple_commands(cmds, env=None, dry=None):
         raise subprocess.CalledProcessError(cmd, returncode)
 
 
-def download_url_to_str(url):
+# Contents of urls retrieved by download_url_to_str
+_URL_CACHE = {}
+
+
+def download_url_to_str(url, no_cache=False):
     """
-    Downloads a url and puts the contents in a string
+    Downloads a url and puts the contents in a string.
+    Contents are cached per url, unless no_cache is True.
     """
+    if not no_cache and url in _URL_CACHE:
+        logger.debug("Using cached contents of url %s", url)
+        return _URL_CACHE[url]
+    html = _download_url_to_str(url)
+    _URL_CACHE[url] = html
+    return html
+
+
+def _download_url_to_str(url):
     logger.info("Retrieving url %s", url)
     try:
         import urllib.request
@@ -247,13 +385,50 @@ def download_url_to_str(url):
     return html
 
 
+def download_url_to_str_if_modified(url, etag=None):
+    """
+    Like download_url_to_str, but asks for a gzipped response and only
+    downloads the contents if they changed since the version with the given etag.
+    Returns a tuple (contents, etag); contents is None if the url was not modified.
+    """
+    logger.info("Retrieving url %s", url)
+    try:
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+    except ImportError:
+        from urllib2 import HTTPError, Request, urlopen
+    request = Request(url, headers={"Accept-Encoding": "gzip"})
+    if etag:
+        request.add_header("If-None-Match", etag)
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if e.code == 304:
+            logger.info("Not modified since last retrieval: %s", url)
+            return None, etag
+        raise
+    try:
+        contents = response.read()
+        if response.info().get("Content-Encoding") == "gzip":
+            import zlib
+
+            contents = zlib.decompress(contents, 16 + zlib.MAX_WBITS)
+        return contents.decode("utf-8"), response.info().get("ETag")
+    finally:
+        response.close()
+
+
+_COMMENT_RE = re.compile(r"#[^\n]*")
+
+
 def iter_strip_comments(python_code):
     """
     Strips comments from python code as a string.
     Does *not* handle '#' appearing in a string
     """
-    for line in python_code.split("\n"):
-        line = line.split("#")[0].strip()
+    # Remove all comments in one go, rather than splitting every line on '#'
+    for line in _COMMENT_RE.sub("", python_code).split("\n"):
+        line = line.strip()
         if not len(line):
             continue
         yield line
@@ -266,80 +441,75 @@ def strip_comments(python_code):
     return "\n".join(iter_strip_comments(python_code))
 
 
-class DummyFile(object):
-    def write(self, text):
-        pass
-
-
 @contextmanager
 def openfile(*args, **kwargs):
     """
     Wrapper around the standard open(...) context, with the option of drymode
     """
     dry = kwargs.pop("dry", qondor.DRYMODE)
-    try:
-        if dry:
-            yield DummyFile()
-        else:
-            with open(*args, **kwargs) as f:
-                yield f
-    finally:
-        pass
+    if dry:
+        # Write to /dev/null instead, in the same mode as requested
+        args = (os.devnull,) + args[1:]
+    with open(*args, **kwargs) as f:
+        yield f
 
 
 def get_exitcode(cmd):
     if is_string(cmd):
         cmd = [cmd]
-    logger.debug('Getting exit code for "%s"', " ".join(cmd))
-    FNULL = open(os.devnull, "w")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Getting exit code for "%s"', " ".join(cmd))
     if qondor.DRYMODE:
         returncode = 0
     else:
-        process = subprocess.Popen(cmd, stdout=FNULL, stderr=subprocess.STDOUT)
-        process.communicate()[0]
-        returncode = process.returncode
+        returncode = subprocess.call(
+            cmd, stdout=get_devnull(), stderr=subprocess.STDOUT
+        )
     logger.debug("Got exit code %s", returncode)
     return returncode
 
 
+# Python 2 / 3 compatibility (https://stackoverflow.com/a/22679982/9209944)
+try:
+    _STRING_TYPES = (basestring,)  # noqa F821
+except NameError:
+    _STRING_TYPES = (str,)
+
+
 def is_string(string):
     """
     Checks strictly whether `string` is a string
-    Python 2 / 3 compatibility (https://stackoverflow.com/a/22679982/9209944)
     """
-    try:
-        basestring
-    except NameError:
-        basestring = str
-    return isinstance(string, basestring)
+    return isinstance(string, _STRING_TYPES)
+
+
+_PIP_VERSION_RE = re.compile(r"[<=>]")
 
 
 def pip_has_version(package):
     """
     For pip install strings: Checks if there is a part that mentions the version
     """
-    for c in ["<", "=", ">"]:
-        if c in package:
-            return True
-    return False
+    return _PIP_VERSION_RE.search(package) is not None
 
 
 def pip_split_version(package):
     """
     For pip install strings: Splits the part of the package name and the version part
     """
-    split_at_index = False
-    for c in ["<", "=", ">"]:
-        if c in package:
-            index = package.index(c)
-            if split_at_index is False or index < split_at_index:
-                split_at_index = index
-    if split_at_index:
-        return package[:split_at_index], package[split_at_index:]
+    match = _PIP_VERSION_RE.search(package)
+    if match and match.start():
+        return package[: match.start()], package[match.start() :]
     return package, ""
 
 
+# Installation paths found via pkg_resources, per module name
+_INSTALLATION_PATH_CACHE = {}
+
+
 def get_installation_path_of_module(module):
+    if module.__name__ in _INSTALLATION_PATH_CACHE:
+        return _INSTALLATION_PATH_CACHE[module.__name__]
     logger.debug("Trying to determine installation path of %s", module.__name__)
     try:
         logger.debug("Using pkg_resources")
@@ -347,6 +517,8 @@ def get_installation_path_of_module(module):
 
         distribution = pkg_resources.get_distribution(module.__name__)
         path = osp.abspath(distribution.location)
+        # Only cache this case; module.__path__ may be relative to the cwd
+        _INSTALLATION_PATH_CACHE[module.__name__] = path
     except Exception:
         logger.debug("From module.__path__")
         path = osp.abspath(module.__path__[0])
@@ -379,22 +551,44 @@ def get_installation_path_of_module(module):
     return path
 
 
-def tarball_python_module(
-    module, outdir=None, allow_uncommitted=True, dry=None, assume_pypi=True
-):
+def get_git_toplevel(path):
     """
-    Takes a python module or the name of a module, and attempts to make an installable
-    pypi-style package tarball out of it.
-    If assume_pypi is True, it will look for the pip installation directory of the package, and check
-    whether there is a setup.py.
-    Otherwise, it will look for the top-level git repository and make a tarball from that, including
-    only files that are tracked by git. Uncommitted changes are included, unless allowed_uncommitted
-    is set to False.
+    Returns the top-level directory of the git repository that contains path.
+    Looks for a .git directory (or file, for worktrees and submodules) in path
+    and its parents, and only asks git if none is found.
+    """
+    current = osp.realpath(path)
+    while True:
+        if osp.exists(osp.join(current, ".git")):
+            return current
+        parent = osp.dirname(current)
+        if parent == current:
+            break
+        current = parent
+    return run_command(["git", "rev-parse", "--show-toplevel"], cwd=path)[0].strip()
+
+
+# Patterns that are left out of tarballs of pip-installed python packages
+TARBALL_EXCLUDES = [
+    "*/lib/python*",
+    "*/include/python*",
+    "*/bin/python*",
+    "*.egg-info*",
+    "*.pyc",
+    "*/.git",
+    "*/dist/*",
+    "*/.fcache/*",
+    "*/examples/*",
+]
+
+
+def _python_module_tarball_source(module, outdir=None, assume_pypi=True):
+    """
+    Determines the directory to make a tarball of for a python module, and the
+    path of that tarball. Returns (directory, outfile).
     """
     import importlib
 
-    if dry is None:
-        dry = qondor.DRYMODE
     outdir = os.getcwd() if outdir is None else outdir
     outdir = osp.abspath(outdir)
 
@@ -427,74 +621,138 @@ def tarball_python_module(
                     module, setuppy
                 )
             )
-        outfile = osp.join(outdir, osp.basename(path) + ".tar")
-        logger.info("Creating tarball from directory %s --> %s", path, outfile)
-        if not dry:
-            with switchdir(path):
-                run_command(
-                    [
-                        "tar",
-                        "-cvf",
-                        outfile,
-                        ".",
-                        "--exclude",
-                        "*/lib/python*",
-                        "--exclude",
-                        "*/include/python*",
-                        "--exclude",
-                        "*/bin/python*",
-                        "--exclude",
-                        "*.egg-info*",
-                        "--exclude",
-                        "*.pyc",
-                        "--exclude",
-                        "*/.git",
-                        "--exclude",
-                        "*/dist/*",
-                        "--exclude",
-                        "*/.fcache/*",
-                        "--exclude",
-                        "*/examples/*",
-                    ]
-                )
     else:
         logger.info("Package %s: Using top level git to create a tarball", path)
         # Get the top-level git dir
-        with switchdir(path):
-            toplevel_git_dir = run_command(["git", "rev-parse", "--show-toplevel"])[
-                0
-            ].strip()
-        # Fix the output name of the tarball
-        outfile = osp.join(outdir, osp.basename(toplevel_git_dir) + ".tar")
-        with switchdir(toplevel_git_dir):
-            if allow_uncommitted:
-                logger.info(
-                    "Creating tarball for %s including uncommitted changes",
-                    toplevel_git_dir,
-                )
-                # Create the tarball with uncommitted changes in it
-                if not dry:
-                    run_command(
-                        "git ls-files -z | xargs -0 tar -cvf {0}".format(outfile),
-                        shell=True,
-                    )
-            else:
-                # Check if there are uncommitted changes
-                try:
-                    run_command(["git", "diff-index", "--quiet", "HEAD", "--"])
-                except subprocess.CalledProcessError:
-                    logger.error(
-                        "Uncommitted changes detected; it is unlikely you want a tarball "
-                        "with some changes not committed."
-                    )
-                    raise
-                # Create the actual tarball of the latest commit
-                if not dry:
-                    run_command(["git", "archive", "-o", outfile, "HEAD"])
+        path = get_git_toplevel(path)
+    # Fix the output name of the tarball
+    outfile = osp.join(outdir, osp.basename(path) + ".tar")
+    return path, outfile
+
+
+def get_python_module_tarball_path(module, outdir=None, assume_pypi=True):
+    """
+    Returns the path of the tarball tarball_python_module would create for module,
+    without creating it. Modules in the same installation directory (or the same
+    git repository if assume_pypi is False) share a tarball.
+    """
+    return _python_module_tarball_source(module, outdir, assume_pypi)[1]
+
+
+def _create_python_module_tarball(
+    path, outfile, allow_uncommitted=True, dry=None, assume_pypi=True
+):
+    """
+    Creates the tarball outfile out of the directory path, as determined by
+    _python_module_tarball_source.
+    """
+    if dry is None:
+        dry = qondor.DRYMODE
+    if assume_pypi:
+        logger.info("Creating tarball from directory %s --> %s", path, outfile)
+        if not dry:
+            # Excludes must come before the path; newer versions of tar
+            # ignore (and fail on) excludes after it
+            run_command(
+                ["tar", "-cf", outfile]
+                + ["--exclude=" + pattern for pattern in TARBALL_EXCLUDES]
+                + ["."],
+                cwd=path,
+                capture_output=False,
+            )
+    elif allow_uncommitted:
+        logger.info("Creating tarball for %s including uncommitted changes", path)
+        # Create the tarball with uncommitted changes in it
+        if not dry:
+            # Pass the tracked files to a single tar via stdin; xargs may split
+            # a long file list over several tar calls that overwrite each other
+            tracked_files = subprocess.check_output(["git", "ls-files", "-z"], cwd=path)
+            cmd = ["tar", "--null", "-T", "-", "-cf", outfile]
+            logger.warning("Issuing command: {0}".format(" ".join(cmd)))
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, cwd=path)
+            process.communicate(tracked_files)
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+    else:
+        # Check if there are uncommitted changes
+        try:
+            run_command(["git", "diff-index", "--quiet", "HEAD", "--"], cwd=path)
+        except subprocess.CalledProcessError:
+            logger.error(
+                "Uncommitted changes detected; it is unlikely you want a tarball "
+                "with some changes not committed."
+            )
+            raise
+        # Create the actual tarball of the latest commit
+        if not dry:
+            run_command(["git", "archive", "-o", outfile, "HEAD"], cwd=path)
     logger.info("Created tarball {0}".format(outfile))
     return outfile
 
 
+def tarball_python_module(
+    module, outdir=None, allow_uncommitted=True, dry=None, assume_pypi=True
+):
+    """
+    Takes a python module or the name of a module, and attempts to make an installable
+    pypi-style package tarball out of it.
+    If assume_pypi is True, it will look for the pip installation directory of the package, and check
+    whether there is a setup.py.
+    Otherwise, it will look for the top-level git repository and make a tarball from that, including
+    only files that are tracked by git. Uncommitted changes are included, unless allowed_uncommitted
+    is set to False.
+    """
+    path, outfile = _python_module_tarball_source(module, outdir, assume_pypi)
+    return _create_python_module_tarball(
+        path, outfile, allow_uncommitted, dry, assume_pypi
+    )
+
+
+def tarball_python_modules(
+    modules,
+    outdir=None,
+    max_workers=8,
+    allow_uncommitted=True,
+    dry=None,
+    assume_pypi=True,
+):
+    """
+    Runs tarball_python_module for multiple modules, in parallel threads
+    (the work is done by tar/git subprocesses). Returns the list of tarballs,
+    in the same order as modules.
+    Modules that share a tarball get it created only once, so no two threads
+    ever write the same file.
+    """
+    outfiles = []
+    jobs = []  # (path, outfile) per unique outfile
+    for module in modules:
+        path, outfile = _python_module_tarball_source(module, outdir, assume_pypi)
+        if outfile not in outfiles:
+            jobs.append((path, outfile))
+        outfiles.append(outfile)
+    if len(jobs) > 1 and ThreadPoolExecutor is not None:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+            futures = [
+                executor.submit(
+                    _create_python_module_tarball,
+                    path,
+                    outfile,
+                    allow_uncommitted,
+                    dry,
+                    assume_pypi,
+                )
+                for path, outfile in jobs
+            ]
+            for future in futures:
+                future.result()
+    else:
+        for path, outfile in jobs:
+            _create_python_module_tarball(
+                path, outfile, allow_uncommitted, dry, assume_pypi
+            )
+    return outfiles
+
+
 def extract_tarball(tarball, outdir=".", verbose=False):
     """
     Extracts a tarball to outdir
@@ -504,7 +762,8 @@ def extract_tarball(tarball, outdir=".", verbose=False):
     create_directory(outdir)
     logger.warning("Extracting {0} ==> {1}".format(tarball, outdir))
     cmd = ["tar", "-x{}f".format("v" if verbose else ""), tarball, "-C", outdir]
-    run_command(cmd)
+    # Without -v tar prints nothing worth reading back
+    run_command(cmd, capture_output=verbose)
 
 
 def extract_tarball_cmssw(tarball, outdir="."):
@@ -518,15 +777,19 @@ def extract_tarball_cmssw(tarball, outdir="."):
     # Get the extracted directory from the tarball:
     import tarfile
 
-    for name in tarfile.open(tarball).getnames():
-        if name.startswith("CMSSW"):
-            break
-    else:
-        raise RuntimeError(
-            'Could not find any directory in {} that starts with "CMSSW"'.format(
-                tarball
+    # Iterate lazily; the CMSSW directory is normally the first member, so there
+    # is no need to read all member headers
+    with tarfile.open(tarball) as tf:
+        for member in tf:
+            if member.name.startswith("CMSSW"):
+                name = member.name
+                break
+        else:
+            raise RuntimeError(
+                'Could not find any directory in {} that starts with "CMSSW"'.format(
+                    tarball
+                )
             )
-        )
     return osp.join(outdir, name)
 
 
@@ -541,17 +804,19 @@ def check_is_cmssw_path(path):
                 osp.basename(path), abs_path
             )
         )
-    if not osp.isdir(path):
-        raise OSError("{0} is not a directory (path: {1})".format(path, abs_path))
+    # If src is a directory, path is one too; only stat path itself to
+    # figure out what went wrong
     if not osp.isdir(osp.join(path, "src")):
+        if not osp.isdir(path):
+            raise OSError("{0} is not a directory (path: {1})".format(path, abs_path))
         raise OSError(
             "{0} is not a directory (path: {1})".format(osp.join(path, "src"), abs_path)
         )
 
 
-def get_clean_env():
-    env = os.environ.copy()
-    for var in [
+# Environment variables that are removed by get_clean_env
+CLEAN_ENV_BLACKLIST = frozenset(
+    [
         "ROOTSYS",
         "PATH",
         "LD_LIBRARY_PATH",
@@ -603,19 +868,39 @@ def get_clean_env():
         "SRM_IFCE_HOME",
         "NUMPY_HOME",
         "DCAP_HOME",
-    ]:
-        if var in env:
-            del env[var]
-    return env
+    ]
+)
+
+
+def get_clean_env():
+    """
+    Returns a copy of the environment without the variables that are set up by
+    e.g. ROOT and CMSSW (see CLEAN_ENV_BLACKLIST)
+    """
+    return {k: v for k, v in os.environ.items() if k not in CLEAN_ENV_BLACKLIST}
+
+
+try:  # py3
+    _UTC = datetime.timezone.utc
+except AttributeError:
+    _UTC = None
 
 
 def convert_to_utc(local_time):
     """
-    Converts a local time to UTC.
-    Implemented for only a few basic timezones.
-    Needs to be extended with pytz if this function
-    get seriously used.
+    Converts a naive local time to a naive UTC time.
+    On python 3 this uses the system timezone rules for the given time (so
+    also correct across DST changes); on python 2 it falls back to offsetting
+    by the current offset, which is implemented for only a few basic timezones.
     """
+    if _UTC is not None:
+        try:
+            new_time = local_time.astimezone(_UTC).replace(tzinfo=None)
+            logger.debug("Converted %s to UTC %s", local_time, new_time)
+            return new_time
+        except ValueError:
+            # Python < 3.6 can't convert naive datetimes
+            pass
     # See: https://stackoverflow.com/a/10854983/9209944
     delta = datetime.timedelta(
         seconds=time.timezone if (time.localtime().tm_isdst == 0) else time.altzone
@@ -628,20 +913,30 @@ def convert_to_utc(local_time):
 
 
 def get_now_utc():
-    return convert_to_utc(datetime.datetime.now())
+    if _UTC is not None:
+        # utcnow() is deprecated from python 3.12
+        return datetime.datetime.now(_UTC).replace(tzinfo=None)
+    return datetime.datetime.utcnow()
+
+
+# Maximum number of seconds sleep_until sleeps before checking the time again
+SLEEP_UNTIL_MAX_STEP = 60
 
 
 def sleep_until(runtime_utc, allowed_lateness=300, is_not_utc=False):
     if is_not_utc:
         runtime_utc = convert_to_utc(runtime_utc)
-    now_utc = get_now_utc()
-    logger.info("Current time (UTC):       %s", now_utc)
+    logger.info("Current time (UTC):       %s", get_now_utc())
     logger.info("Scheduled run time (UTC): %s", runtime_utc)
 
-    delta = runtime_utc - now_utc
-    delta_seconds = abs(delta.total_seconds())
+    # Compare as POSIX timestamps; runtime_utc is a naive datetime in UTC
+    runtime_ts = (
+        calendar.timegm(runtime_utc.timetuple()) + runtime_utc.microsecond / 1e6
+    )
+    delta = runtime_ts - time.time()
+    delta_seconds = abs(delta)
 
-    if delta < datetime.timedelta(seconds=0):
+    if delta < 0:
         # The job is too late; runtime_utc has already passed
         if delta_seconds < allowed_lateness:
             logger.info(
@@ -661,7 +956,13 @@ def sleep_until(runtime_utc, allowed_lateness=300, is_not_utc=False):
             raise RuntimeError
     else:
         logger.info("Job is early by %s seconds, sleeping", delta_seconds)
-        time.sleep(delta_seconds)
+        # Sleep in bounded steps and recheck the wall clock, so that clock jumps
+        # (e.g. suspend/resume) during a long sleep do not make the job late
+        while True:
+            remaining = runtime_ts - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, SLEEP_UNTIL_MAX_STEP))
         return 0
 
 
@@ -689,11 +990,42 @@ def check_proxy():
         pass
 
 
+# Cached output of `voms-proxy-info -path`; None means it was not looked up yet
+_VOMS_PROXY_PATH = None
+
+
+def get_voms_proxy_path():
+    """
+    Returns the path to the grid proxy as reported by `voms-proxy-info -path`,
+    or an empty string if it could not be determined.
+    The command is only run once per process; subsequent calls return the cached value.
+    """
+    global _VOMS_PROXY_PATH
+    if _VOMS_PROXY_PATH is None:
+        try:
+            _VOMS_PROXY_PATH = run_command(["voms-proxy-info", "-path"])[0].strip()
+        except Exception:
+            _VOMS_PROXY_PATH = ""
+    return _VOMS_PROXY_PATH
+
+
+# Results of dist_is_editable, per (project name, sys.path)
+_DIST_IS_EDITABLE_CACHE = {}
+
+
 def dist_is_editable(dist):
     """
     Is distribution an editable install?
     see: https://stackoverflow.com/a/42583363/9209944
     """
+    name = dist if is_string(dist) else dist.project_name
+    key = (name, tuple(sys.path))
+    if key not in _DIST_IS_EDITABLE_CACHE:
+        _DIST_IS_EDITABLE_CACHE[key] = _dist_is_editable(dist)
+    return _DIST_IS_EDITABLE_CACHE[key]
+
+
+def _dist_is_editable(dist):
     # If a string is passed, convert it to a module object
     if is_string(dist):
         import pkg_resources
@@ -713,27 +1045,37 @@ def dist_is_editable(dist):
     return False
 
 
-def _iter_chunkify_nrange(list_length, n_chunks):
+def _chunk_bounds(list_length, n_chunks, i_chunk):
     """
-    Makes n_chunks chunks out of a range(list_length) list.
-    Returns empty lists if n_chunks > list_length.
+    Returns the (start, stop) indices of the i_chunk-th of n_chunks chunks out
+    of a range(list_length) list. Chunk i contains the indices that are in
+    [i * list_length/n_chunks, (i+1) * list_length/n_chunks).
     """
     n_per_chunk_f = float(list_length) / n_chunks
-    boundaries = [(i * n_per_chunk_f, (i + 1) * n_per_chunk_f) for i in range(n_chunks)]
-    for left, right in boundaries:
-        indices_in_chunk = []
-        for i in range(list_length):
-            if i >= left and i < right:
-                indices_in_chunk.append(i)
-        yield indices_in_chunk
+    start = int(math.ceil(i_chunk * n_per_chunk_f))
+    stop = int(math.ceil((i_chunk + 1) * n_per_chunk_f))
+    return min(start, list_length), min(stop, list_length)
+
+
+# Sequences that can be sliced as they are; anything else is first turned into a list
+_SLICEABLE_TYPES = (list, tuple, type(range(0)))
+
+
+def _slice_as_list(mylist, start, stop):
+    chunk = mylist[start:stop]
+    return chunk if isinstance(chunk, list) else list(chunk)
 
 
 def iter_chunkify(mylist, n_chunks):
     """
     Makes n_chunks chunks out of mylist.
+    Returns empty lists if n_chunks > len(mylist).
     """
-    for indices in _iter_chunkify_nrange(len(mylist), n_chunks):
-        yield [mylist[i] for i in indices]
+    if not isinstance(mylist, _SLICEABLE_TYPES):
+        mylist = list(mylist)
+    for i_chunk in range(n_chunks):
+        start, stop = _chunk_bounds(len(mylist), n_chunks, i_chunk)
+        yield _slice_as_list(mylist, start, stop)
 
 
 def chunkify(mylist, n_chunks=None, chunksize=None):
@@ -750,4 +1092,13 @@ def chunkify(mylist, n_chunks=None, chunksize=None):
 
 
 def get_ith_chunk(mylist, n_chunks, i_chunk):
-    return chunkify(mylist, n_chunks)[i_chunk]
+    # Only the requested chunk of a range or tuple is turned into a list
+    if not isinstance(mylist, _SLICEABLE_TYPES):
+        mylist = list(mylist)
+    # Negative indices count from the back, as for the list of chunks
+    if i_chunk < 0:
+        i_chunk += n_chunks
+    if not 0 <= i_chunk < n_chunks:
+        raise IndexError("list index out of range")
+    start, stop = _chunk_bounds(len(mylist), n_chunks, i_chunk)
+    return _slice_as_list(mylist, start, stop)